@@ -1,25 +1,30 @@
 import asyncio
-# --- Try setting uvloop policy ---
+# --- Try using uvloop ---
 try:
     import uvloop
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-    print("Using uvloop event loop policy.")
+    new_event_loop = uvloop.new_event_loop
 except ImportError:
-    print("uvloop not found, using default asyncio event loop policy.")
-# --- End uvloop policy setting ---
+    uvloop = None
+    new_event_loop = asyncio.new_event_loop
+# --- End uvloop setup ---
 
 import os
+import atexit
 import logging
-import google.generativeai as genai
 from telegram import Update
-# Import Bot separately if needed in set_webhook
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, TypeHandler
-from PIL import Image
-# import asyncio # Already imported above
-import json
-import io # <--- Add this import
-import base64
-import binascii
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
+# google.generativeai and PIL are imported lazily on first receipt to keep cold starts fast
+import orjson
+import re
+import time
+import random
+import hashlib
+import mimetypes
+import functools
+from typing import TypedDict
+from collections import OrderedDict
+import io
 from dotenv import load_dotenv
 from flask import Flask, request, Response # Import Flask components
 
@@ -30,7 +35,26 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("No BOT_TOKEN set for Flask application")
 BOT_USERNAME = "@Bill_Splitting_AI_Bot" # Keep or fetch dynamically if needed
+# Literal mention that must not run into a longer username (e.g. @Bill_Splitting_AI_Bot_v2)
+BOT_MENTION_RE = re.compile(re.escape(BOT_USERNAME) + r"(?!\w)")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Cap on concurrent Gemini calls so bursts of receipts don't trip API rate limits (429s)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "10"))
+# Attempts per Gemini call when it fails with a transient error (429/5xx)
+GEMINI_MAX_ATTEMPTS = 3
+# Receipts arriving within the batch window are sent to Gemini as one multimodal request
+GEMINI_MAX_BATCH = int(os.getenv("GEMINI_MAX_BATCH", "8"))
+GEMINI_BATCH_WINDOW_MS = int(os.getenv("GEMINI_BATCH_WINDOW_MS", "500"))
+# Receipts are shrunk to this longest side and re-encoded as JPEG before upload to cut vision tokens
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 85
+# Split results are memoized by receipt content so forwarded/retried photos skip Gemini
+SPLIT_CACHE_SIZE = 512
+SPLIT_CACHE_TTL_SECONDS = 600
+# Translation table backslash-escaping every character Telegram's MarkdownV2 reserves
+MARKDOWN_V2_ESCAPES = str.maketrans({char: "\\" + char for char in "_*[]()~`>#+-=|{}.!\\"})
+# Optional self-hosted Bot API server (telegram-bot-api --local), e.g. http://local-api:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 # --- Add WEBHOOK_URL ---
 WEBHOOK_URL = os.getenv("WEBHOOK_URL") # e.g., https://your-api-gateway-id.execute-api.region.amazonaws.com/main
 logger = logging.getLogger(__name__)
@@ -41,221 +65,550 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+if uvloop:
+    logger.info("Using uvloop event loop.")
+else:
+    logger.info("uvloop not found, using default asyncio event loop.")
 
 # --- Gemini AI Setup ---
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-pro-exp-03-25')
-else:
+# The SDK (and its grpc/protobuf imports) is only loaded when the first receipt arrives,
+# so health checks, /setwebhook and text commands don't pay for it on cold start.
+if not GEMINI_API_KEY:
     logger.warning("GEMINI_API_KEY not found. AI processing will fail.")
-    model = None # Handle cases where the model might not be available
+
+# Static instructions live in the model's system instruction, so per-call prompts only carry
+# the orders. The prefix is far too small for Gemini's implicit or explicit context caching,
+# so this is about keeping the instructions in one place, not about billing.
+RECEIPT_SYSTEM_INSTRUCTION = """
+You are an expert receipt analyzing AI.
+Analyze receipt images and calculate the bill split based on the orders you are given.
+Pay attention to quantities and prices. Be careful, some items can be shared between people.
+Return each person's final amount to pay.
+"""
+RECEIPT_PROMPT_TEMPLATE = """
+Orders for this receipt:
+{participants_info}
+"""
+BATCH_PROMPT_TEMPLATE = """
+You are given {count} receipts. Each receipt image directly follows a "Receipt i:" label
+with that receipt's orders; only use those orders for that image.
+Return a JSON array with exactly {count} entries, where entry i lists each person's final
+amount to pay for Receipt i.
+"""
+
+class PersonShare(TypedDict):
+    """One participant's share of a receipt, as returned by Gemini's JSON response schema."""
+    person: str
+    total: float
+
+@functools.cache
+def get_model():
+    """Returns the Gemini model, importing and configuring the SDK on first use."""
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel('gemini-2.5-pro-exp-03-25', system_instruction=RECEIPT_SYSTEM_INSTRUCTION)
+
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
 
 # --- Telegram Bot Setup ---
 # Initialize the Application outside the request context for efficiency
 
 
 # --- Bot Command Handlers ---
+# Reply texts are static, so build them once at import
+START_TEXT = f"Hi! Add me to a group, then tag me ({BOT_USERNAME}) in a message with a receipt photo to split the bill."
+MODEL_NOT_CONFIGURED_TEXT = "AI Model is not configured. Cannot process receipt."
+MISSING_PARTICIPANTS_TEXT = "Please provide participant information in the caption!"
+PROCESSING_TEXT = "Processing receipt and calculating split..."
+RECEIPT_ERROR_TEXT = "Sorry, an error occurred processing the receipt. Please check the image and caption format."
+HELP_TEXT = (
+    "How to use:\n"
+    "1. Add me to your group.\n"
+    "2. Take a clear photo of your receipt.\n"
+    "3. Send the photo to the group with caption in this format:\n\n"
+    f"{BOT_USERNAME}\n"
+    "Person1: item1, item2\n"
+    "Person2: item1, item2\n\n"
+    "Example:\n"
+    f"{BOT_USERNAME}\n"
+    "Alice: burger, coke\n"
+    "Bob: pasta, salad\n\n"
+    "Commands:\n"
+    "/start - Welcome message\n"
+    "/help - This message"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"Hi! Add me to a group, then tag me ({BOT_USERNAME}) in a message with a receipt photo to split the bill.")
+    await update.message.reply_text(START_TEXT)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "How to use:\n"
-        "1. Add me to your group.\n"
-        "2. Take a clear photo of your receipt.\n"
-        "3. Send the photo to the group with caption in this format:\n\n"
-        f"{BOT_USERNAME}\n"
-        "Person1: item1, item2\n"
-        "Person2: item1, item2\n\n"
-        "Example:\n"
-        f"{BOT_USERNAME}\n"
-        "Alice: burger, coke\n"
-        "Bob: pasta, salad\n\n"
-        "Commands:\n"
-        "/start - Welcome message\n"
-        "/help - This message"
-    )
+    await update.message.reply_text(HELP_TEXT)
+
+def escape_markdown_v2(text: str) -> str:
+    """Escapes all MarkdownV2 special characters in a single str.translate pass."""
+    return text.translate(MARKDOWN_V2_ESCAPES)
 
 # --- Receipt Handling Logic ---
 async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message or not message.photo:
-        print("Received update without message or photo.")
+        logger.debug("Received update without message or photo.")
         # Optionally reply if it's a direct message or mention without photo
         # await message.reply_text("Please send a photo with a caption.")
         return
 
-    photo = message.photo[-1]
+    photo = pick_receipt_photo(message.photo)
     caption = message.caption or ""
-    image_bytes = None # Use bytes instead of path
 
-    if BOT_USERNAME not in caption:
-        print(f"Bot username {BOT_USERNAME} not found in caption: '{caption}'. Ignoring.")
+    if BOT_MENTION_RE.match(caption):
+        # Documented format puts the mention first: an anchored match plus a slice, no full scan
+        participants_info, mentions = caption[len(BOT_USERNAME):], 1
+    else:
+        # Otherwise one pass both detects the mention and strips it from the orders
+        participants_info, mentions = BOT_MENTION_RE.subn("", caption, count=1)
+    if not mentions:
+        logger.debug("Bot username %s not found in caption: '%s'. Ignoring.", BOT_USERNAME, caption)
         return
 
-    if not model:
-         await message.reply_text("AI Model is not configured. Cannot process receipt.")
+    if not GEMINI_API_KEY:
+         await message.reply_text(MODEL_NOT_CONFIGURED_TEXT)
          return
 
+    ack_task = None
     try:
-        participants_info = caption.replace(BOT_USERNAME, "").strip()
+        participants_info = participants_info.strip()
         if not participants_info:
-            await message.reply_text("Please provide participant information in the caption!")
+            await message.reply_text(MISSING_PARTICIPANTS_TEXT)
             return
 
-        print("Sending 'Processing...' message.")
-        await message.reply_text("Processing receipt and calculating split...")
-
-        print("Getting photo file object...")
+        # The ack reply and the file lookup are independent Telegram calls, so overlap them
+        logger.debug("Sending 'Processing...' message and getting photo file object...")
+        ack_task = asyncio.create_task(message.reply_text(PROCESSING_TEXT))
         photo_file = await photo.get_file()
-        print(f"Got photo file object: {photo_file.file_id}")
-
-        # Download photo to memory (BytesIO)
-        print("Downloading photo to memory...")
-        image_stream = io.BytesIO()
-        await photo_file.download_to_memory(image_stream)
-        image_stream.seek(0) # Reset stream position
-        print("Photo downloaded to memory.")
-
-        print("Calling process_receipt_with_ai...")
-        split_result = await process_receipt_with_ai(image_stream, participants_info)
-        print("Received result from AI.")
-
-        escaped_result = split_result.replace(".", r"\.") # For MarkdownV2
-        if not escaped_result.strip():
-            escaped_result = "Could not extract split details."
-        print("Sending final result message...")
-        await message.reply_text(
+        logger.debug("Got photo file object: %s", photo_file.file_id)
+
+        # Download photo to memory in a single buffer
+        logger.debug("Downloading photo to memory...")
+        image_bytes = await photo_file.download_as_bytearray()
+        logger.debug("Photo downloaded to memory.")
+
+        logger.debug("Calling process_receipt_with_ai...")
+        # Telegram photos are JPEGs; fall back to that if the file path has no known extension
+        mime_type = mimetypes.guess_type(photo_file.file_path or "")[0] or "image/jpeg"
+        split_result = await process_receipt_with_ai(
+            image_bytes, participants_info, mime_type, max(photo.width, photo.height), message.chat_id
+        )
+        logger.debug("Received result from AI.")
+        status_message = await ack_task
+
+        escaped_result = escape_markdown_v2(format_split_results(split_result))
+        logger.debug("Editing status message with final result...")
+        # Edit the ack in place rather than sending a second message (one fewer against the per-chat limit)
+        await status_message.edit_text(
             f"🧮 *Bill Split Results:*\n```\n{escaped_result}\n```",
             parse_mode='MarkdownV2'
         )
 
     except Exception as e:
-        logger.error(f"Error in handle_receipt: {str(e)}", exc_info=True)
-        await message.reply_text(
-            "Sorry, an error occurred processing the receipt. Please check the image and caption format."
-        )
-    # No finally block needed for file cleanup when using BytesIO
-
-async def process_receipt_with_ai(image_stream: io.BytesIO, participants_info: str) -> str:
-    if not model:
+        logger.error("Error in handle_receipt: %s", e, exc_info=True)
+        status_message = None
+        if ack_task is not None:
+            try:
+                status_message = await ack_task
+            except Exception:
+                pass
+        if status_message:
+            await status_message.edit_text(RECEIPT_ERROR_TEXT)
+        else:
+            await message.reply_text(RECEIPT_ERROR_TEXT)
+    # No finally block needed for file cleanup when downloading to memory
+
+def pick_receipt_photo(photo_sizes: tuple):
+    """Picks the smallest PhotoSize that still covers MAX_IMAGE_SIDE, or the largest one available.
+
+    Telegram lists sizes smallest first; anything bigger would only be downscaled again before upload.
+    """
+    for photo_size in photo_sizes:
+        if max(photo_size.width, photo_size.height) >= MAX_IMAGE_SIDE:
+            return photo_size
+    return photo_sizes[-1]
+
+def format_split_results(shares: list) -> str:
+    """Renders Gemini's per-person totals as an aligned plain-text table."""
+    if not shares:
+        return "Could not extract split details."
+    width = max(len("Total"), *(len(share["person"]) for share in shares))
+    lines = [f"{share['person']:<{width}}  {float(share['total']):>10.2f}" for share in shares]
+    lines.append(f"{'Total':<{width}}  {sum(float(share['total']) for share in shares):>10.2f}")
+    return "\n".join(lines)
+
+async def process_receipt_with_ai(image_bytes: bytearray, participants_info: str,
+                                  mime_type: str = "image/jpeg", longest_side: int = None,
+                                  chat_id: int = None) -> list:
+    if not GEMINI_API_KEY:
         raise ValueError("Gemini AI model not initialized.")
     try:
-        # Open image directly from the BytesIO stream
-        image = Image.open(image_stream)
-        prompt = f"""
-        You are an expert receipt analyzing AI.
-        Analyze this receipt image and calculate the bill split based on the following orders:
-        {participants_info}
-        Pay attention to quantities and prices. Be careful, some items can be shared between people.
-        Return only final split results
-        """
-        # Make sure generate_content_async is the correct method name for your version
-        response = await model.generate_content_async([prompt, image])
-        return response.text.strip()
+        cache_key = split_cache_key(image_bytes, participants_info)
+        cached = get_cached_split(cache_key)
+        if cached is not None:
+            logger.debug("Returning cached split result.")
+            return cached
+        # Decoding and re-encoding is CPU-bound; keep it off the event loop
+        image = await asyncio.to_thread(prepare_receipt_image, image_bytes, mime_type, longest_side)
+        # Queue the receipt for the batch worker and wait for its split
+        result = asyncio.get_running_loop().create_future()
+        await get_receipt_queue().put((chat_id, (image, participants_info, result)))
+        split_result = await result
+        cache_split(cache_key, split_result)
+        return split_result
     except Exception as e:
-        logger.error(f"Error in process_receipt_with_ai: {str(e)}", exc_info=True)
+        logger.error("Error in process_receipt_with_ai: %s", e, exc_info=True)
         # Re-raise the exception so it's caught by handle_receipt's handler
         raise
 
+# --- Split Result Cache ---
+# LRU of cache key -> (expiry timestamp, split result)
+split_cache = OrderedDict()
+
+def split_cache_key(image_bytes: bytearray, participants_info: str) -> str:
+    """Hashes the raw receipt bytes together with the caption's orders."""
+    digest = hashlib.blake2b(image_bytes, digest_size=16)
+    digest.update(participants_info.encode())
+    return digest.hexdigest()
+
+def get_cached_split(cache_key: str):
+    """Returns the cached split result for the key, or None if missing or expired."""
+    entry = split_cache.get(cache_key)
+    if entry is None:
+        return None
+    expires_at, split_result = entry
+    if expires_at < time.monotonic():
+        del split_cache[cache_key]
+        return None
+    split_cache.move_to_end(cache_key)
+    return split_result
+
+def cache_split(cache_key: str, split_result: list):
+    """Stores a split result, evicting the least recently used entry when full."""
+    split_cache[cache_key] = (time.monotonic() + SPLIT_CACHE_TTL_SECONDS, split_result)
+    split_cache.move_to_end(cache_key)
+    while len(split_cache) > SPLIT_CACHE_SIZE:
+        split_cache.popitem(last=False)
+
+def prepare_receipt_image(image_bytes: bytearray, mime_type: str = "image/jpeg", longest_side: int = None) -> dict:
+    """Returns the receipt as a Gemini blob, shrunk to MAX_IMAGE_SIDE to reduce input tokens.
+
+    Passing encoded bytes avoids the SDK re-encoding a PIL image to PNG on every call, and
+    photos already within MAX_IMAGE_SIDE are sent as downloaded without being decoded at all.
+    """
+    if longest_side is not None and longest_side <= MAX_IMAGE_SIDE:
+        return {"mime_type": mime_type, "data": bytes(image_bytes)}
+    from PIL import Image
+    # Open image directly from the downloaded bytes
+    image = Image.open(io.BytesIO(image_bytes))
+    # For JPEGs, let libjpeg decode at a reduced DCT scale instead of full resolution
+    image.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+# --- Receipt Batching ---
+# Receipts are coalesced into a single Gemini request so the prompt overhead is paid once
+# per batch rather than once per receipt. Created lazily so they bind to the running loop.
+receipt_queue = None
+receipt_batch_worker = None
+# Strong references to in-flight batches so they aren't garbage collected while callers wait
+receipt_batch_tasks = set()
+
+def get_receipt_queue() -> asyncio.Queue:
+    """Returns the receipt queue, starting the batch worker on first use."""
+    global receipt_queue, receipt_batch_worker
+    if receipt_queue is None:
+        receipt_queue = asyncio.Queue()
+    if receipt_batch_worker is None or receipt_batch_worker.done():
+        receipt_batch_worker = asyncio.get_running_loop().create_task(run_receipt_batches())
+    return receipt_queue
+
+async def run_receipt_batches():
+    """Collects up to GEMINI_MAX_BATCH receipts within the batch window and dispatches them.
+
+    Receipts are grouped by chat before being sent, so a batch never mixes chats and a
+    misordered Gemini reply can't post one group's split into another group.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        queued = [await receipt_queue.get()]
+        deadline = loop.time() + GEMINI_BATCH_WINDOW_MS / 1000
+        while len(queued) < GEMINI_MAX_BATCH:
+            try:
+                queued.append(receipt_queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                queued.append(await asyncio.wait_for(receipt_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        batches_by_chat = {}
+        for chat_id, receipt in queued:
+            batches_by_chat.setdefault(chat_id, []).append(receipt)
+        # Don't hold up collection of the next batch while Gemini works on these
+        for batch in batches_by_chat.values():
+            batch_task = loop.create_task(analyze_receipt_batch(batch))
+            receipt_batch_tasks.add(batch_task)
+            batch_task.add_done_callback(receipt_batch_tasks.discard)
+
+async def analyze_receipt_batch(batch: list):
+    """Sends a batch of (image, participants_info, future) receipts to Gemini and resolves the futures."""
+    if len(batch) == 1:
+        await resolve_receipt_individually(*batch[0])
+        return
+    try:
+        import google.generativeai as genai
+        # Pair each image with its own orders so Gemini never has to match them by position
+        contents = [BATCH_PROMPT_TEMPLATE.format(count=len(batch))]
+        for i, (image, participants_info, _) in enumerate(batch, 1):
+            contents += [f"Receipt {i}:\n{participants_info}", image]
+        response = await generate_with_retry(
+            get_model(),
+            contents,
+            genai.GenerationConfig(response_mime_type="application/json", response_schema=list[list[PersonShare]]),
+        )
+        try:
+            results = orjson.loads(response.text)
+        except orjson.JSONDecodeError:
+            results = None
+        if not isinstance(results, list) or len(results) != len(batch):
+            # One malformed reply shouldn't fail every receipt in the batch
+            logger.warning("Expected %d split results from Gemini, got: %s. Retrying receipts individually.",
+                           len(batch), response.text[:200])
+            await asyncio.gather(*(resolve_receipt_individually(*receipt) for receipt in batch))
+            return
+        for (_, _, future), split_result in zip(batch, results):
+            if not future.done():
+                future.set_result(split_result)
+    except Exception as e:
+        logger.error("Error analyzing receipt batch of %d: %s", len(batch), e, exc_info=True)
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+async def resolve_receipt_individually(image: dict, participants_info: str, future: asyncio.Future):
+    """Runs one receipt through its own Gemini request and settles its future."""
+    try:
+        import google.generativeai as genai
+        prompt = RECEIPT_PROMPT_TEMPLATE.format(participants_info=participants_info)
+        response = await generate_with_retry(
+            get_model(),
+            [prompt, image],
+            genai.GenerationConfig(response_mime_type="application/json", response_schema=list[PersonShare]),
+        )
+        split_result = orjson.loads(response.text)
+    except Exception as e:
+        logger.error("Error analyzing receipt: %s", e, exc_info=True)
+        if not future.done():
+            future.set_exception(e)
+        return
+    if not future.done():
+        future.set_result(split_result)
+
+async def generate_with_retry(model, contents: list, generation_config):
+    """Calls Gemini under the concurrency cap, retrying transient errors with exponential backoff."""
+    from google.api_core import exceptions as google_exceptions
+    transient_errors = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    )
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            async with gemini_semaphore:
+                return await model.generate_content_async(contents, generation_config=generation_config)
+        except transient_errors as e:
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            # Back off outside the semaphore so other receipts can use the slot meanwhile
+            delay = 2 ** attempt + random.random()
+            logger.warning("Transient Gemini error (%s), retrying in %.1fs", e, delay)
+            await asyncio.sleep(delay)
+
+
+# Photos whose caption mentions the bot; built once and shared by the receipt handlers
+RECEIPT_MENTION_FILTER = filters.PHOTO & filters.CaptionRegex(BOT_MENTION_RE)
 
 # Optional: Add a handler for private chats if needed
-# ptb_app.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(BOT_USERNAME) & filters.ChatType.PRIVATE, handle_receipt))
+# ptb_app.add_handler(MessageHandler(RECEIPT_MENTION_FILTER & filters.ChatType.PRIVATE, handle_receipt))
 
 
 # --- Flask Application ---
 app = Flask(__name__)
 
-ptb_app = Application.builder().token(BOT_TOKEN).build()
+# Against api.telegram.org, HTTP/2 lets the ack, file lookup and result replies share one
+# multiplexed TLS connection. A self-hosted Bot API server only speaks HTTP/1.1, so keep
+# PTB's default there and rely on the pooled keep-alive connections instead.
+ptb_request = HTTPXRequest(
+    http_version="1.1" if TELEGRAM_API_URL else "2", connection_pool_size=64, read_timeout=60
+)
+# AIORateLimiter queues outgoing calls within Telegram's flood limits and retries on RetryAfter
+ptb_builder = (
+    Application.builder().token(BOT_TOKEN).request(ptb_request).rate_limiter(AIORateLimiter(max_retries=3))
+)
+if TELEGRAM_API_URL:
+    # In local mode getFile returns a path on the shared volume, so photo downloads
+    # become filesystem reads instead of HTTPS round-trips to api.telegram.org
+    api_url = TELEGRAM_API_URL.rstrip('/')
+    ptb_builder = ptb_builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot").local_mode(True)
+ptb_app = ptb_builder.build()
     # --- Register Handlers with PTB Application ---
 ptb_app.add_handler(CommandHandler("start", start))
 ptb_app.add_handler(CommandHandler("help", help_command))
     # Use MessageHandler to specifically catch photos with captions mentioning the bot
 ptb_app.add_handler(MessageHandler(
-    filters.PHOTO & filters.CaptionRegex(BOT_USERNAME) & (filters.ChatType.GROUPS | filters.ChatType.SUPERGROUP),
+    RECEIPT_MENTION_FILTER & filters.ChatType.GROUPS,
     handle_receipt
 ))
+
+# --- Persistent Event Loop ---
+# One loop for the lifetime of the process (uvloop-backed when available) so PTB's
+# HTTPX connection pool stays warm across webhook requests.
+LOOP = new_event_loop()
+asyncio.set_event_loop(LOOP)
+
+# PTB is initialized on the first update rather than at import, so cold starts serving
+# health checks skip the getMe round-trip. The Application is never shut down between
+# requests, which keeps its connection pool alive across warm invocations.
+ptb_initialized = False
+ptb_init_lock = asyncio.Lock()
+
+async def ensure_ptb_initialized():
+    """Initializes the PTB application exactly once per process."""
+    global ptb_initialized
+    if ptb_initialized:
+        return
+    async with ptb_init_lock:
+        if not ptb_initialized:
+            await ptb_app.initialize()
+            ptb_initialized = True
+
+@atexit.register
+def close_loop():
+    """Tears LOOP down the way uvloop.run/asyncio.run would: cancel tasks, shut PTB down, finalize asyncgens."""
+    if LOOP.is_closed():
+        return
+    pending = asyncio.all_tasks(LOOP)
+    for pending_task in pending:
+        pending_task.cancel()
+    LOOP.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    LOOP.run_until_complete(ptb_app.shutdown())
+    LOOP.run_until_complete(LOOP.shutdown_asyncgens())
+    LOOP.close()
+
+def is_relevant_update(update_data: dict) -> bool:
+    """Cheaply checks the raw update for anything a registered handler could act on.
+
+    Lets the webhooks drop chatter (plain messages, photos without a mention, other update
+    types) without building a PTB Update object graph or dispatching background work.
+    """
+    if not isinstance(update_data, dict):
+        return False
+    message = update_data.get("message") or update_data.get("edited_message")
+    if not message:
+        return False
+    text = message.get("text")
+    if text and text.startswith("/"):
+        return True
+    return "photo" in message and BOT_USERNAME in message.get("caption", "")
+
+async def process_update_data(update_data: dict):
+    """Deserializes a raw Telegram update and dispatches it through PTB."""
+    await ensure_ptb_initialized()
+    update = Update.de_json(update_data, ptb_app.bot)
+    logger.debug("Processing update: %s", update.update_id)
+    await ptb_app.process_update(update)
+
+def process_update_task(update_data: dict):
+    """Processes an update outside the webhook request.
+
+    Dispatched through dispatch_update_task; on Lambda, Zappa invokes it by module path in a
+    separate asynchronous invocation.
+    """
+    try:
+        LOOP.run_until_complete(process_update_data(update_data))
+    except Exception as e:
+        logger.error("Error processing update in background task: %s", e, exc_info=True)
+
+@functools.cache
+def dispatch_update_task():
+    """Wraps process_update_task with Zappa's @task.
+
+    zappa (and boto3 with it) is only imported on the Flask/Zappa path, so the aiohttp
+    entry point doesn't load it.
+    """
+    from zappa.asynchronous import task
+    return task(process_update_task)
+
 @app.route('/webhook', methods=['POST'])
 def webhook(): # Changed to synchronous def
-    """Webhook endpoint to receive updates from Telegram. Uses asyncio.run for PTB."""
-    print("Webhook received a request.")
+    """Webhook endpoint to receive updates from Telegram.
+
+    Hands relevant updates to process_update_task via Zappa's @task. On Lambda that is a
+    separate async invocation, so Telegram gets its 200 right away. Anywhere else Zappa runs
+    the task inline, so the response waits for the whole update, including the Gemini call.
+    """
+    logger.debug("Webhook received a request.")
     if request.content_type != 'application/json':
-        logger.warning(f"Invalid content type: {request.content_type}")
+        logger.warning("Invalid content type: %s", request.content_type)
         return Response(status=403) # Forbidden
 
     try:
-        update_data = request.get_json(force=True)
-        print(f"Received update data: {update_data}")
-
-        # --- Use asyncio.run to handle the async PTB processing ---
-        async def process():
-            # Let PTB handle initialization lazily if needed
-            # await ptb_app.initialize() # Removed explicit initialize again
+        update_data = orjson.loads(request.get_data(cache=False))
+        logger.debug("Received update data keys: %s",
+                     list(update_data) if isinstance(update_data, dict) else type(update_data))
 
-            update = Update.de_json(update_data, ptb_app.bot)
-            print(f"Processing update: {update.update_id}")
-            await ptb_app.process_update(update)
+        if not is_relevant_update(update_data):
+            logger.debug("Ignoring update without a command or bot mention.")
+            return Response(status=200)
 
-        # --- Explicitly create and manage a new event loop ---
-        loop = asyncio.new_event_loop()
-        # asyncio.set_event_loop(loop) # <-- Remove this line
-        try:
-            loop.run_until_complete(process()) # Run directly on the loop object
-        finally:
-            # Ensure the loop is closed even if errors occur in process()
-            loop.close()
-        # --- End explicit loop management ---
+        # Hand the (possibly slow) Gemini work off so Telegram gets its 200 OK right away
+        dispatch_update_task()(update_data)
 
         # Return 200 OK to Telegram
         return Response(status=200)
 
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON: {e}", exc_info=True)
+    except orjson.JSONDecodeError as e:
+        logger.error("Error decoding JSON: %s", e, exc_info=True)
         return Response("Invalid JSON received", status=400)
     except Exception as e:
-        logger.error(f"Error processing update in webhook: {e}", exc_info=True)
+        logger.error("Error processing update in webhook: %s", e, exc_info=True)
         return Response("Error processing update", status=500)
 
+async def register_webhook(full_webhook_url: str):
+    """Points Telegram at the given URL, reusing the application's bot (and its pooled HTTPX client)."""
+    await ensure_ptb_initialized()
+    await ptb_app.bot.set_webhook(full_webhook_url)
+
 # --- Add /setwebhook route from template concept ---
 @app.route('/setwebhook', methods=['GET', 'POST'])
 def set_telegram_webhook(): # Changed to synchronous def
-    """Sets the Telegram webhook URL. Uses asyncio.run for PTB."""
-    from telegram import Bot # Import Bot locally for this function
+    """Sets the Telegram webhook URL using the already initialized PTB bot."""
     if not WEBHOOK_URL:
         return "Webhook URL not configured in environment variables.", 500
 
     # Construct the full webhook URL Telegram should POST to
     full_webhook_url = f"{WEBHOOK_URL.rstrip('/')}/webhook" # Append your webhook path
-    print(f"Attempting to set webhook to: {full_webhook_url}")
-
-    # --- Use asyncio.run to handle the async PTB call ---
-    async def set_hook():
-        try:
-            # Create a temporary Bot instance just for this call
-            temp_bot = Bot(token=BOT_TOKEN)
-
-            await temp_bot.set_webhook(full_webhook_url)
-            print(f"Webhook successfully set to {full_webhook_url}")
-            return f"Webhook successfully set to {full_webhook_url}", 200
-        except Exception as e:
-            logger.error(f"Failed to set webhook inside set_hook: {e}", exc_info=True)
-            # Re-raise or return an error indication if needed,
-            # but the outer try/except will catch it if raised.
-            raise # Re-raise the exception to be caught below
+    logger.debug("Attempting to set webhook to: %s", full_webhook_url)
 
     try:
-        # --- Explicitly create and manage a new event loop ---
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            result, status_code = loop.run_until_complete(set_hook())
-        finally:
-            loop.close()
-        return result, status_code
-        # --- End explicit loop management ---
+        LOOP.run_until_complete(register_webhook(full_webhook_url))
+        logger.info("Webhook successfully set to %s", full_webhook_url)
+        return f"Webhook successfully set to {full_webhook_url}", 200
     except Exception as e:
-        # Log the final error caught from asyncio.run
-        logger.error(f"Failed to set webhook: {e}", exc_info=True)
+        logger.error("Failed to set webhook: %s", e, exc_info=True)
         return f"Failed to set webhook: {e}", 500
 
 # --- Add index route from template concept ---
@@ -264,12 +617,70 @@ def index():
     """Basic index route for health check or verification."""
     return "Flask server is running.", 200
 
-# --- Remove the old lambda_handler and main() polling logic ---
-
-# Optional: Add for local development testing (not used by Zappa)
-# if __name__ == '__main__':
-#     # Note: Running locally this way won't receive webhooks unless you use ngrok or similar
-#     # and manually set the webhook URL with Telegram.
-#     # It's primarily for syntax checking or testing specific functions.
-#     # For full local testing, consider running PTB's polling mode temporarily.
-#     app.run(debug=True, port=5000)
\ No newline at end of file
+# --- Native async server (aiohttp) ---
+# Zappa/Lambda only speaks WSGI, so the Flask app above stays the deployed entry point.
+# On a long-running host, `python app.py` serves the same routes from aiohttp directly
+# on LOOP, so concurrent receipts overlap instead of each blocking a worker.
+def create_aiohttp_app():
+    """Builds an aiohttp application exposing the webhook, setwebhook and index routes."""
+    from aiohttp import web
+
+    # Strong references to in-flight updates so they aren't garbage collected mid-run
+    background_tasks = set()
+
+    def on_update_done(update_task: asyncio.Task):
+        background_tasks.discard(update_task)
+        if not update_task.cancelled() and update_task.exception():
+            logger.error("Error processing update in webhook: %s", update_task.exception(),
+                         exc_info=update_task.exception())
+
+    async def aiohttp_webhook(request):
+        if request.content_type != 'application/json':
+            logger.warning("Invalid content type: %s", request.content_type)
+            return web.Response(status=403)
+        try:
+            update_data = orjson.loads(await request.read())
+        except orjson.JSONDecodeError as e:
+            logger.error("Error decoding JSON: %s", e, exc_info=True)
+            return web.Response(text="Invalid JSON received", status=400)
+        if not is_relevant_update(update_data):
+            return web.Response(status=200)
+        # Acknowledge immediately; the update is processed in the background
+        update_task = asyncio.create_task(process_update_data(update_data))
+        background_tasks.add(update_task)
+        update_task.add_done_callback(on_update_done)
+        return web.Response(status=200)
+
+    async def aiohttp_set_webhook(request):
+        if not WEBHOOK_URL:
+            return web.Response(text="Webhook URL not configured in environment variables.", status=500)
+        full_webhook_url = f"{WEBHOOK_URL.rstrip('/')}/webhook"
+        try:
+            await register_webhook(full_webhook_url)
+        except Exception as e:
+            logger.error("Failed to set webhook: %s", e, exc_info=True)
+            return web.Response(text=f"Failed to set webhook: {e}", status=500)
+        logger.info("Webhook successfully set to %s", full_webhook_url)
+        return web.Response(text=f"Webhook successfully set to {full_webhook_url}")
+
+    async def aiohttp_index(request):
+        return web.Response(text="aiohttp server is running.")
+
+    async def drain_background_tasks(aio_app):
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    aio_app = web.Application()
+    aio_app.router.add_post('/webhook', aiohttp_webhook)
+    aio_app.router.add_route('*', '/setwebhook', aiohttp_set_webhook)
+    aio_app.router.add_get('/', aiohttp_index)
+    aio_app.on_shutdown.append(drain_background_tasks)
+    # run_app closes LOOP itself, so shut PTB down before that happens
+    aio_app.on_cleanup.append(lambda aio_app: ptb_app.shutdown())
+    return aio_app
+
+if __name__ == '__main__':
+    # Note: Telegram must be pointed at this server: expose it (e.g. via ngrok), set
+    # WEBHOOK_URL to the public URL and open /setwebhook once.
+    from aiohttp import web
+    web.run_app(create_aiohttp_app(), port=int(os.getenv("PORT", "8080")), loop=LOOP)